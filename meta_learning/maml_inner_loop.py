@@ -16,10 +16,10 @@
 # Lint as python3
 """Custom getter utilities to leverage existing models for MAML."""
 
+import collections
 from typing import List, Mapping, Optional, Text, Tuple
 
 import gin
-import six
 from six.moves import zip
 import tensorflow.compat.v1 as tf
 
@@ -46,13 +46,17 @@ class MAMLInnerLoopGradientDescent(object):
                                                 maml_model_fn=maml_model_fn,
                                                 inner_loss_fn=inner_loss_fn)
 
+  Note, the inner loop is constructed once at graph construction time, e.g.
+  within the model_fn of an estimator, and the resulting graph is executed for
+  every meta iteration without being rebuilt.
   """
 
   def __init__(self,
                learning_rate = 0.001,
                use_second_order = True,
                var_scope = None,
-               learn_inner_lr = False):
+               learn_inner_lr = False,
+               use_xla_jit = False):
     """Create an instance.
 
     Args:
@@ -62,7 +66,9 @@ class MAMLInnerLoopGradientDescent(object):
       use_second_order: If True, we will backpropagate through the gradients,
         using second order information. If False, we will stop the backprop
         computation to exclude the gradients, thus, only using first order
-        information.
+        information. The inner loop gradients are stopped right where they are
+        computed, therefore, the outer loop tf.gradients call prunes the
+        second order subgraph without requiring any stop_gradients argument.
       var_scope: String specifying scope of variables to apply gradients to.
         If variable starts with this (e.g. "a_func/pose_fc0/weights" starts with
         "a_func/pose_fc" This can be used to implement MAML models that only
@@ -70,36 +76,99 @@ class MAMLInnerLoopGradientDescent(object):
         large CNN). Note that the *outer* loop optimization will still train
         all the variables, unless told otherwise.
       learn_inner_lr: If True, use learned per-tf.Variable inner loop learning
-        rates initialized at `learning_rate`.
+        rates initialized at `learning_rate`. All learning rates are packed
+        into a single vector variable with one entry per adapted variable.
+        Note, this variable is incompatible with checkpoints containing the
+        previous per variable learning rates.
+      use_xla_jit: If True, the fused gradient descent steps of the inner loop
+        are placed within an XLA jit scope, such that the elementwise updates
+        are compiled into a single kernel. Note, this has no effect on TPUs
+        which always compile the whole graph with XLA.
     """
-    self._variable_cache = []
     self._learning_rate = learning_rate
     self._use_second_order = use_second_order
     self._learn_inner_lr = learn_inner_lr
     self._custom_getter_variable_cache = {}
+    self._master_variable_cache = {}
     self._var_scope = var_scope
-    self._lr_cache = {}
+    self._use_xla_jit = use_xla_jit
+    self._lr_vec = None
+    self._lr_index = {}
+    # The variable names and whether or not they are adapted are invariant
+    # across inner loop steps, therefore, we only compute them once.
+    self._ordered_names = None
+    self._adapted_names = None
+
+  def _create_learning_rates(self, var_names):
+    """Creates the packed learning rate variable for all `var_names`.
+
+    The variable 'inner_learning_rates/inner_lrs' has shape (len(var_names),)
+    and is created with tf.AUTO_REUSE. Therefore, all instances which share a
+    variable scope within a graph have to adapt the same number of variables,
+    otherwise tf.get_variable raises a shape mismatch error.
 
-  def _get_learning_rate(self, var_name):
-    """Returns the learning rate variable for variable with name `var_name`."""
-    try:
-      return self._lr_cache[var_name]
-    except KeyError:
-      with tf.variable_scope(
-          'inner_learning_rates', reuse=tf.AUTO_REUSE, use_resource=True):
-        name = '_'.join(six.ensure_str(var_name).split('/')) + '_inner_lr'
-        learning_rate = tf.get_variable(
-            name, shape=(), dtype=tf.float32,
-            initializer=tf.initializers.constant(self._learning_rate))
-      self._lr_cache[var_name] = learning_rate
-      return learning_rate
+    Args:
+      var_names: The names of all variables adapted in the inner loop. The
+        learning rate of var_names[i] is stored at index i.
+    """
+    with tf.variable_scope(
+        'inner_learning_rates', reuse=tf.AUTO_REUSE, use_resource=True):
+      self._lr_vec = tf.get_variable(
+          'inner_lrs', shape=(len(var_names),), dtype=tf.float32,
+          initializer=tf.initializers.constant(self._learning_rate))
+    self._lr_index = {name: index for index, name in enumerate(var_names)}
+
+  def _get_learning_rates(self, lr_indices, sizes=None):
+    """Returns the learned learning rates at `lr_indices`.
+
+    Args:
+      lr_indices: The indices of the variables within the packed learning
+        rates, see _get_learning_rate_indices.
+      sizes: Optionally, the number of elements of every variable. If provided,
+        the learning rates are repeated for every element of the flattened and
+        concatenated variables.
+
+    Returns:
+      A learning rate vector gathered from the packed learning rates, holding
+      one entry per index or, if `sizes` is provided, one entry per variable
+      element.
+    """
+    learning_rates = tf.gather(self._lr_vec, lr_indices)
+    if sizes is not None:
+      # We expand the per variable learning rates within the graph, such that
+      # neither the graph constants nor the outer loop gradient of the packed
+      # learning rates scale with the number of variable elements.
+      learning_rates = tf.repeat(learning_rates, sizes)
+    return learning_rates
+
+  def _get_learning_rate_indices(self, var_names):
+    """Returns the indices of `var_names` within the packed learning rates.
+
+    Args:
+      var_names: The names of adapted variables.
+
+    Returns:
+      A list with the index of every name in `var_names`.
+
+    Raises:
+      ValueError: If no learning rate has been created for one of `var_names`.
+    """
+    indices = []
+    for var_name in var_names:
+      try:
+        indices.append(self._lr_index[var_name])
+      except KeyError:
+        raise ValueError(
+            'No inner loop learning rate exists for {}, the set of adapted '
+            'variables has to be invariant across inner loop steps.'.format(
+                var_name))
+    return indices
 
   def add_parameter_summaries(self):
     """Add parameter summaries for the MAML inner loop."""
     if self._learn_inner_lr:
-      for name, var in self._lr_cache.items():
-        tf.summary.scalar('inner_loop_learning_rates/' + six.ensure_str(name),
-                          var)
+      if self._lr_vec is not None:
+        tf.summary.histogram('inner_loop_learning_rates', self._lr_vec)
     else:
       tf.summary.scalar('inner_loop_learning_rate',
                         tf.constant(self._learning_rate))
@@ -144,7 +213,11 @@ class MAMLInnerLoopGradientDescent(object):
     """Compute the gradients for all variables and apply them to the variables.
 
     We alter the internal self._custom_getter_variable_cache with new
-    "variables" for which a gradient descent step has been applied.
+    "variables" for which a gradient descent step has been applied. Note, the
+    new "variables" are pure tensor expressions of the previous ones, hence,
+    the outer loop differentiates through all inner steps with a single
+    tf.gradients call. The per step gradients cannot be deferred since every
+    step requires the gradient of the previous one.
 
     Args:
       loss: The loss tensor we want to derive the gradients for.
@@ -159,33 +232,230 @@ class MAMLInnerLoopGradientDescent(object):
           'Our custom getter has to be invoked at least once before'
           'we can compute gradients.')
 
-    # We keep track of the previously used variables.
-    self._variable_cache.append(self._custom_getter_variable_cache)
-
-    # The old cache contains the latest variable state.
-    variable_cache_old = self._variable_cache[-1]
-    # The new cache will contain the updated variables.
-    self._custom_getter_variable_cache = {}
-
-    variable_list = list(variable_cache_old.keys())
+    # The old cache contains the latest variable state. Note, we do not keep
+    # a history of previous states, the outer loop gradients only require the
+    # graph which references them.
+    variable_cache_old = self._custom_getter_variable_cache
+    # In case we change the model in an iteration.
+    if (self._ordered_names is None or
+        len(self._ordered_names) != len(variable_cache_old)):
+      self._ordered_names = list(variable_cache_old.keys())
+      self._adapted_names = [
+          name for name in self._ordered_names
+          if self._var_scope is None or name.startswith(self._var_scope)
+      ]
+    variable_list = self._ordered_names
+
+    # Note, the learning rates are created prior to replacing the cache since
+    # this function might be called within our custom getter scope.
+    if self._learn_inner_lr and self._lr_vec is None:
+      self._create_learning_rates(self._adapted_names)
+
+    # We only compute gradients for the adapted variables, such that no
+    # backward pass is constructed for variables outside of var_scope.
     gradients = tf.gradients(
-        [loss], [variable_cache_old[name] for name in variable_list])
-    for name, gradient in zip(variable_list, gradients):
-      # In case we change the model in an iteration.
-      ignore_var = (
-          self._var_scope is not None and not name.startswith(self._var_scope))
-      if (gradient is None or ignore_var):
-        self._custom_getter_variable_cache[name] = variable_cache_old[name]
+        [loss], [variable_cache_old[name] for name in self._adapted_names])
+    if not self._use_second_order:
+      # We stop the gradients right away such that the outer loop gradient
+      # computation never traverses the backward graph of the inner loop.
+      gradients = [self._stop_gradient(gradient) for gradient in gradients]
+
+    # We group the variables with dense gradients by dtype, such that every
+    # group can be updated with a single fused gradient descent step. Sparse
+    # gradients, e.g. of embedding lookups, are applied as sparse updates.
+    names_by_dtype = collections.OrderedDict()
+    sparse_names = []
+    gradients_by_name = {}
+    for name, gradient in zip(self._adapted_names, gradients):
+      if gradient is None:
         continue
+      if isinstance(gradient, tf.IndexedSlices):
+        sparse_names.append(name)
+      else:
+        dtype = variable_cache_old[name].dtype.base_dtype
+        names_by_dtype.setdefault(dtype, []).append(name)
+      gradients_by_name[name] = gradient
+
+    # Note, the updates are applied to the float32 master copies of reduced
+    # precision variables, see _get_master_variable.
+    updated_variables = {}
+    for names in names_by_dtype.values():
+      variables = [
+          self._get_master_variable(name, variable_cache_old[name])
+          for name in names
+      ]
+      sizes = [variable.shape.num_elements() for variable in variables]
+      lr_indices = None
+      if self._learn_inner_lr:
+        lr_indices = self._get_learning_rate_indices(names)
+      updated_variables.update(zip(names, self._apply_gradient_step(
+          variables=variables,
+          gradients=[gradients_by_name[name] for name in names],
+          learning_rate=self._get_step_learning_rate(lr_indices, sizes))))
+
+    if sparse_names:
+      lr_indices = None
+      if self._learn_inner_lr:
+        lr_indices = self._get_learning_rate_indices(sparse_names)
+      learning_rate = self._get_step_learning_rate(lr_indices)
       if self._learn_inner_lr:
-        learning_rate = self._get_learning_rate(name)
+        learning_rates = tf.unstack(learning_rate)
       else:
-        learning_rate = self._learning_rate
-      scaled_gradient = learning_rate * gradient
-      if not self._use_second_order:
-        scaled_gradient = tf.stop_gradient(scaled_gradient)
-      self._custom_getter_variable_cache[name] = (
-          variable_cache_old[name] - scaled_gradient)
+        learning_rates = [learning_rate] * len(sparse_names)
+      for name, learning_rate in zip(sparse_names, learning_rates):
+        updated_variables[name] = self._sparse_gradient_step(
+            variable=self._get_master_variable(name, variable_cache_old[name]),
+            gradient=gradients_by_name[name],
+            learning_rate=learning_rate)
+
+    for name, updated_variable in list(updated_variables.items()):
+      dtype = variable_cache_old[name].dtype.base_dtype
+      if dtype != updated_variable.dtype.base_dtype:
+        # We keep the float32 master copy and hand out the reduced precision
+        # view through our custom getter.
+        self._master_variable_cache[name] = updated_variable
+        updated_variables[name] = tf.cast(updated_variable, dtype)
+
+    # The new cache contains the updated variables, all other variables are
+    # passed through unchanged.
+    self._custom_getter_variable_cache = {
+        name: updated_variables.get(name, variable_cache_old[name])
+        for name in variable_list
+    }
+
+  def _stop_gradient(self, gradient):
+    """Stops the backprop through `gradient`, retaining sparse gradients.
+
+    Args:
+      gradient: A gradient tensor, a tf.IndexedSlices gradient or None.
+
+    Returns:
+      The gradient with stopped backprop, of the same type as `gradient`.
+    """
+    if gradient is None:
+      return None
+    if isinstance(gradient, tf.IndexedSlices):
+      # tf.stop_gradient would convert the gradient into a dense tensor.
+      return tf.IndexedSlices(
+          tf.stop_gradient(gradient.values), gradient.indices,
+          gradient.dense_shape)
+    return tf.stop_gradient(gradient)
+
+  def _get_step_learning_rate(self, lr_indices, sizes=None):
+    """Returns the learning rate used for a gradient step.
+
+    Args:
+      lr_indices: The indices of the updated variables within the packed
+        learning rates, only used if learn_inner_lr.
+      sizes: Optionally, the number of elements of every variable, see
+        _get_learning_rates.
+
+    Returns:
+      The scalar learning rate or, if learn_inner_lr, a vector with one
+      learning rate per index in `lr_indices` or per element if `sizes` is
+      provided.
+    """
+    if self._learn_inner_lr:
+      learning_rate = self._get_learning_rates(lr_indices, sizes)
+    else:
+      learning_rate = self._learning_rate
+    if not self._use_second_order and tf.is_tensor(learning_rate):
+      learning_rate = tf.stop_gradient(learning_rate)
+    return learning_rate
+
+  def _get_master_variable(self, name, variable):
+    """Returns the variable the gradient descent step is applied to.
+
+    Reduced precision variables, e.g. within a bfloat16_scope on TPUs, are
+    updated using a float32 master copy, such that the inner loop steps do not
+    round the parameters to the reduced precision. The custom getter only
+    hands out the reduced precision view of the master copy.
+
+    Args:
+      name: The name of the variable.
+      variable: The cached variable tensor, as returned by the custom getter.
+
+    Returns:
+      The float32 master copy for reduced precision variables, otherwise the
+      unaltered `variable`.
+    """
+    if variable.dtype.base_dtype not in (tf.bfloat16, tf.float16):
+      return variable
+    try:
+      return self._master_variable_cache[name]
+    except KeyError:
+      return tf.cast(variable, tf.float32)
+
+  def _sparse_gradient_step(self, variable, gradient, learning_rate):
+    """Applies a gradient descent step for a tf.IndexedSlices gradient.
+
+    Only the rows of `variable` referenced by the gradient are updated, hence,
+    the update scales with the number of looked up rows instead of the size
+    of `variable`.
+
+    Args:
+      variable: The variable tensor to update.
+      gradient: A tf.IndexedSlices gradient with respect to `variable`.
+      learning_rate: A scalar learning rate.
+
+    Returns:
+      The updated variable tensor.
+    """
+    scaled_values = learning_rate * tf.cast(gradient.values,
+                                            variable.dtype.base_dtype)
+    # Note, updates for duplicated indices are accumulated.
+    return tf.tensor_scatter_nd_sub(
+        variable, tf.expand_dims(gradient.indices, axis=-1), scaled_values)
+
+  def _apply_gradient_step(self, variables, gradients, learning_rate):
+    """Applies a single fused gradient descent step to all variables.
+
+    All variables are flattened and concatenated, such that the update is
+    computed by one elementwise operation instead of one per variable. If
+    use_xla_jit is enabled, the update is compiled with XLA.
+
+    Args:
+      variables: A list of variable tensors of the same dtype.
+      gradients: A list with the gradient for every variable, reduced precision
+        gradients are cast to the dtype of `variables`.
+      learning_rate: Either a scalar learning rate or a vector containing one
+        learning rate per element of the flattened and concatenated variables.
+
+    Returns:
+      A list with the updated variable tensors, in the order of `variables`.
+    """
+    if self._use_xla_jit:
+      with tf.xla.experimental.jit_scope():
+        return self._fused_gradient_step(variables, gradients, learning_rate)
+    return self._fused_gradient_step(variables, gradients, learning_rate)
+
+  def _fused_gradient_step(self, variables, gradients, learning_rate):
+    """Computes the flattened gradient descent step, see _apply_gradient_step.
+
+    Args:
+      variables: A list of variable tensors of the same dtype.
+      gradients: A list with the gradient for every variable, reduced precision
+        gradients are cast to the dtype of `variables`.
+      learning_rate: Either a scalar learning rate or a vector containing one
+        learning rate per element of the flattened and concatenated variables.
+
+    Returns:
+      A list with the updated variable tensors, in the order of `variables`.
+    """
+    sizes = [variable.shape.num_elements() for variable in variables]
+    flat_variables = tf.concat(
+        [tf.reshape(variable, [-1]) for variable in variables], axis=0)
+    # The gradients of reduced precision variables are applied to their float32
+    # master copies, see _get_master_variable.
+    flat_gradients = tf.cast(
+        tf.concat([tf.reshape(gradient, [-1]) for gradient in gradients],
+                  axis=0), flat_variables.dtype.base_dtype)
+    flat_updated_variables = flat_variables - learning_rate * flat_gradients
+    return [
+        tf.reshape(updated_variable, variable.shape)
+        for updated_variable, variable in zip(
+            tf.split(flat_updated_variables, sizes), variables)
+    ]
 
   def _extract_train_loss(self, train_fn_result):
     """Extract the train loss from the train fn results.
@@ -220,16 +490,19 @@ class MAMLInnerLoopGradientDescent(object):
   ):
     """The inner loop MAML optimization.
 
-    The inner_loop function iterates over the input feature list and creates
-    a new custom_getter for every iteration. The first iteration will
-    initialize the variables. In every additional invocation we will create a
-    custom getter with the updated variables according to the latest gradient
-    descent step.
+    The inner_loop function iterates over the input feature list within a
+    single variable scope using our custom getter. The first invocation will
+    initialize the variables. Every additional invocation will query the
+    custom getter which returns the updated variables according to the latest
+    gradient descent step.
 
     Args:
       inputs_list:  list/tuple of (feature, label) tuples. We will iterate over
         the inputs_list and take a gradient step after every step but the last,
-        resulting in len(inputs_list) - 1 gradient updates.
+        resulting in len(inputs_list) - 1 gradient updates. All entries belong
+        to a single task, tasks are vectorized by the caller, e.g.
+        MAMLModel._map_task_learn maps this function over the task dimension
+        using tf.map_fn with parallel_iterations=num_tasks or pfor.
       inference_network_fn: A function which creates an inference network
         acccording to abstract_model.AbstractT2RModel. Please see the
         AbstractT2RModel class for more documentation on the function
@@ -262,9 +535,26 @@ class MAMLInnerLoopGradientDescent(object):
     if params is None:
       params = {}
     params['is_inner_loop'] = True
+
+    # Compute unconditioned outputs. These outputs are helpful to gain insights
+    # into the model changes due to the inner loop. Typically, these outputs
+    # are only used for summary generations. We compute them prior to any
+    # gradient step, such that the initial variables are populated in our
+    # custom getter cache and no separate reuse scope is required.
+    with tf.variable_scope(
+        'inner_loop',
+        custom_getter=self._create_variable_getter_fn()) as inner_loop_scope:
+      unconditioned_outputs = inference_network_fn(
+          features=val_features, labels=val_labels, mode=mode, params=params)
+
+    # Note, the inner loop is unrolled at graph construction time on purpose.
+    # Variables are created lazily through our custom getter, which is not
+    # supported within a tf.while_loop body, and the per step outputs are
+    # returned as python lists. Besides, inner_loop itself is typically called
+    # within tf.map_fn, therefore, the graph is only constructed once per task
+    # batch and the number of inner loop steps is small.
     for train_features, train_labels in inputs_list[:-1]:
-      with tf.variable_scope(
-          'inner_loop', custom_getter=self._create_variable_getter_fn()):
+      with tf.variable_scope(inner_loop_scope):
         outputs = inference_network_fn(
             features=train_features,
             labels=train_labels,
@@ -287,10 +577,12 @@ class MAMLInnerLoopGradientDescent(object):
       self._compute_and_apply_gradients(train_loss)
 
     # Compute the final inner outputs and loss to monitor if the network
-    # adaptation actually helps.
+    # adaptation actually helps. Note, this forward pass is not redundant, the
+    # outputs of the last loop iteration were computed prior to the last
+    # gradient step and the conditioned outputs use the validation data.
+    # Callers such as MAMLModel rely on len(inputs_list) inner outputs/losses.
     final_train_features, final_train_labels = inputs_list[-2]
-    with tf.variable_scope(
-        'inner_loop', custom_getter=self._create_variable_getter_fn()):
+    with tf.variable_scope(inner_loop_scope):
       final_inner_outputs = inference_network_fn(
           features=final_train_features,
           labels=final_train_labels,
@@ -306,8 +598,7 @@ class MAMLInnerLoopGradientDescent(object):
         params=params)
     inner_losses.append(self._extract_train_loss(final_train_fn_result))
 
-    with tf.variable_scope(
-        'inner_loop', custom_getter=self._create_variable_getter_fn()):
+    with tf.variable_scope(inner_loop_scope):
       # Compute the conditioned outputs, the actual outputs of the overall
       # model. These outputs are used in the outer loop to determine the overall
       # loss.
@@ -315,14 +606,5 @@ class MAMLInnerLoopGradientDescent(object):
       conditioned_outputs = inference_network_fn(
           features=val_features, labels=val_labels, mode=mode, params=params)
 
-    # Compute unconditioned outputs. These outputs are helpful to gain insights
-    # into the model changes due to the inner loop. Typically, these outputs
-    # are only used for summary generations, therefore do not add a big
-    # overhead.
-    with tf.variable_scope('inner_loop', reuse=True):
-      params['is_inner_loop'] = True
-      unconditioned_outputs = inference_network_fn(
-          features=val_features, labels=val_labels, mode=mode, params=params)
-
     return [unconditioned_outputs,
             conditioned_outputs], inner_outputs, inner_losses
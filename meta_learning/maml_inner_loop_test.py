@@ -51,6 +51,51 @@ def inference_network_fn(features, labels=None, mode=None, params=None):
   return {'prediction': x * features[COEFF_A]}
 
 
+def embedding_inference_network_fn(features,
+                                   labels=None,
+                                   mode=None,
+                                   params=None):
+  del labels, mode, params
+  embeddings = tf.get_variable(
+      'embeddings',
+      shape=(3, 1),
+      dtype=tf.float32,
+      initializer=tf.constant_initializer(X_INIT, dtype=tf.float32))
+  x = tf.nn.embedding_lookup(embeddings, [1])[0]
+  return {'prediction': x * features[COEFF_A]}
+
+
+def two_variable_inference_network_fn(features,
+                                      labels=None,
+                                      mode=None,
+                                      params=None):
+  del labels, mode, params
+  x = tf.get_variable(
+      'x',
+      shape=(1,),
+      dtype=tf.float32,
+      initializer=tf.constant_initializer([X_INIT], dtype=tf.float32))
+  y = tf.get_variable(
+      'y',
+      shape=(1,),
+      dtype=tf.float32,
+      initializer=tf.constant_initializer([X_INIT], dtype=tf.float32))
+  return {'prediction': x * y * features[COEFF_A]}
+
+
+def float16_inference_network_fn(features,
+                                 labels=None,
+                                 mode=None,
+                                 params=None):
+  del labels, mode, params
+  x = tf.get_variable(
+      'x',
+      shape=(1,),
+      dtype=tf.float16,
+      initializer=tf.constant_initializer([X_INIT], dtype=tf.float16))
+  return {'prediction': tf.cast(x, tf.float32) * features[COEFF_A]}
+
+
 def model_train_fn(features,
                    labels,
                    inference_outputs,
@@ -152,15 +197,18 @@ class MAMLInnerLoopGradientDescentTest(
         self.assertNotEmpty(
             maml_inner_loop_instance._custom_getter_variable_cache)
 
-        # Initially we have nothing in the variable cache.
-        self.assertEmpty(maml_inner_loop_instance._variable_cache)
+        initial_variables = dict(
+            maml_inner_loop_instance._custom_getter_variable_cache)
         maml_inner_loop_instance._compute_and_apply_gradients(loss)
 
-        # compute_and_apply_gradients has populated the cache.
-        self.assertLen(maml_inner_loop_instance._variable_cache, 1)
+        # compute_and_apply_gradients has replaced the cached variables.
+        self.assertIsNot(
+            initial_variables['init_variables/x'],
+            maml_inner_loop_instance._custom_getter_variable_cache[
+                'init_variables/x'])
 
         sess.run(tf.global_variables_initializer())
-        variables = sess.run(maml_inner_loop_instance._variable_cache[0])
+        variables = sess.run(initial_variables)
         self.assertEqual(variables['init_variables/x'], X_INIT)
 
   @parameterized.parameters((False,), (True,))
@@ -207,12 +255,11 @@ class MAMLInnerLoopGradientDescentTest(
 
         # Again we know that the x sequence is converging, the loss might
         # not be go down monotonically due to the inner loop though.
-        x_previous = sess.run(
-            list(maml_inner_loop_instance._variable_cache[0].values())[0])
+        x_variable = tf.trainable_variables(scope='inner_loop/x')[0]
+        x_previous = sess.run(x_variable)
         for _ in range(10):
           sess.run([train_op], feed_dict={features[COEFF_A]: [COEFF_A_VALUE]})
-          x_new = sess.run(
-              list(maml_inner_loop_instance._variable_cache[0].values())[0])
+          x_new = sess.run(x_variable)
           self.assertLess(x_new, x_previous)
           x_previous = x_new
 
@@ -259,12 +306,11 @@ class MAMLInnerLoopGradientDescentTest(
 
         # We know that the x sequence is converging, the loss might
         # not be go down monotonically due to the inner loop though.
-        x_previous = sess.run(
-            list(maml_inner_loop_instance._variable_cache[0].values())[0])
+        x_variable = tf.trainable_variables(scope='inner_loop/x')[0]
+        x_previous = sess.run(x_variable)
         for _ in range(10):
           sess.run([train_op], feed_dict={features[COEFF_A]: [COEFF_A_VALUE]})
-          x_new = sess.run(
-              list(maml_inner_loop_instance._variable_cache[0].values())[0])
+          x_new = sess.run(x_variable)
           self.assertLess(x_new, x_previous)
           x_previous = x_new
 
@@ -274,6 +320,127 @@ class MAMLInnerLoopGradientDescentTest(
     # required computation nodes.
     self.assertLess(len(tensors[0]), len(tensors[1]))
 
+  @parameterized.parameters((False,), (True,))
+  def test_inner_loop_var_scope(self, learn_inner_lr):
+    # Variables outside of var_scope are not adapted in the inner loop,
+    # therefore, the conditioned and unconditioned outputs are identical.
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+      maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent(
+          learning_rate=LEARNING_RATE,
+          var_scope='inner_loop/not_adapted',
+          learn_inner_lr=learn_inner_lr)
+      inputs = create_inputs()
+      features, _ = inputs
+      outputs, _, _ = maml_inner_loop_instance.inner_loop(
+          [inputs, inputs, inputs], inference_network_fn, model_train_fn)
+      sess.run(tf.global_variables_initializer())
+      unconditioned_outputs, conditioned_outputs = sess.run(
+          outputs, feed_dict={features[COEFF_A]: [COEFF_A_VALUE]})
+      self.assertAllClose(unconditioned_outputs['prediction'],
+                          conditioned_outputs['prediction'])
+
+  @parameterized.parameters(
+      (False, False), (False, True), (True, False), (True, True))
+  def test_inner_loop_sparse_gradients(self, learn_inner_lr, use_second_order):
+    # Embedding lookups result in tf.IndexedSlices gradients, only the looked
+    # up rows are adapted in the inner loop.
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+      maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent(
+          learning_rate=LEARNING_RATE,
+          use_second_order=use_second_order,
+          learn_inner_lr=learn_inner_lr)
+      inputs = create_inputs()
+      features, _ = inputs
+      maml_inner_loop_instance.inner_loop(
+          [inputs, inputs, inputs], embedding_inference_network_fn,
+          model_train_fn)
+      embeddings = maml_inner_loop_instance._custom_getter_variable_cache[
+          'inner_loop/embeddings']
+      # The sparse gradients are applied by a scatter update.
+      self.assertEqual(embeddings.op.type, 'TensorScatterSub')
+      sess.run(tf.global_variables_initializer())
+      np_embeddings = sess.run(
+          embeddings, feed_dict={features[COEFF_A]: [COEFF_A_VALUE]})
+      self.assertEqual(np_embeddings[0, 0], X_INIT)
+      self.assertLess(np_embeddings[1, 0], X_INIT)
+      self.assertEqual(np_embeddings[2, 0], X_INIT)
+
+  @parameterized.parameters((False,), (True,))
+  def test_inner_loop_reduced_precision(self, learn_inner_lr):
+    # The inner loop step is smaller than the float16 resolution around
+    # X_INIT, it is only preserved by the float32 master copy.
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+      maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent(
+          learning_rate=LEARNING_RATE, learn_inner_lr=learn_inner_lr)
+      inputs = create_inputs()
+      features, _ = inputs
+      maml_inner_loop_instance.inner_loop(
+          [inputs, inputs], float16_inference_network_fn, model_train_fn)
+      x_view = maml_inner_loop_instance._custom_getter_variable_cache[
+          'inner_loop/x']
+      x_master = maml_inner_loop_instance._master_variable_cache[
+          'inner_loop/x']
+      self.assertEqual(x_view.dtype, tf.float16)
+      self.assertEqual(x_master.dtype, tf.float32)
+      sess.run(tf.global_variables_initializer())
+      np_x_view, np_x_master = sess.run(
+          [x_view, x_master],
+          feed_dict={features[COEFF_A]: [COEFF_A_VALUE]})
+      self.assertEqual(np_x_view[0], X_INIT)
+      self.assertLess(np_x_master[0], X_INIT)
+
+  def test_inner_loop_xla_jit(self):
+    # The fused update ops are marked for XLA compilation and yield the same
+    # results as without XLA.
+    np_outputs = []
+    for use_xla_jit in [False, True]:
+      graph = tf.Graph()
+      with tf.Session(graph=graph) as sess:
+        maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent(
+            learning_rate=LEARNING_RATE, use_xla_jit=use_xla_jit)
+        inputs = create_inputs()
+        features, _ = inputs
+        outputs, _, _ = maml_inner_loop_instance.inner_loop(
+            [inputs, inputs, inputs], inference_network_fn, model_train_fn)
+        x = maml_inner_loop_instance._custom_getter_variable_cache[
+            'inner_loop/x']
+        if use_xla_jit:
+          self.assertTrue(x.op.get_attr('_XlaCompile'))
+        else:
+          with self.assertRaises(ValueError):
+            x.op.get_attr('_XlaCompile')
+        sess.run(tf.global_variables_initializer())
+        np_outputs.append(
+            sess.run(outputs[1],
+                     feed_dict={features[COEFF_A]: [COEFF_A_VALUE]}))
+    self.assertAllClose(np_outputs[0]['prediction'],
+                        np_outputs[1]['prediction'])
+
+  def test_packed_learning_rates(self):
+    # All learned learning rates are packed into a single variable, indexed
+    # in the order of the adapted variables.
+    graph = tf.Graph()
+    with tf.Session(graph=graph):
+      maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent(
+          learning_rate=LEARNING_RATE, learn_inner_lr=True)
+      inputs = create_inputs()
+      maml_inner_loop_instance.inner_loop(
+          [inputs, inputs, inputs], two_variable_inference_network_fn,
+          model_train_fn)
+      lr_variables = tf.global_variables(scope='inner_learning_rates')
+      self.assertLen(lr_variables, 1)
+      self.assertEqual(lr_variables[0].op.name,
+                       'inner_learning_rates/inner_lrs')
+      adapted_names = maml_inner_loop_instance._adapted_names
+      self.assertEqual(adapted_names, ['inner_loop/x', 'inner_loop/y'])
+      self.assertEqual(lr_variables[0].shape.as_list(), [len(adapted_names)])
+      self.assertEqual(
+          maml_inner_loop_instance._lr_index,
+          {name: index for index, name in enumerate(adapted_names)})
+
   @parameterized.parameters((False,), (True,))
   def test_inner_loop_reuse(self, learn_inner_lr):
     # Inner loop should create as many trainable vars in 'inner_loop' scope as a
@@ -255,6 +255,10 @@ class MAMLModel(abstract_model.AbstractT2RModel):
     """
     del config
 
+    # Note, we create a new inner loop instance for every model_fn invocation,
+    # hence, its variable caches are local to every replica when the meta
+    # batch is distributed across devices, e.g. with a tf.distribute strategy
+    # passed as train_distribute to the gin configurable RunConfig.
     maml_inner_loop_instance = maml_inner_loop.MAMLInnerLoopGradientDescent()
 
     def task_learn(inputs_list):